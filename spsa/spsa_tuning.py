@@ -10,19 +10,26 @@ This implements the SPSA variant used by Fishtest and OpenBench:
 This is simpler and more effective for chess engine tuning than classical SPSA.
 """
 
-import time
-import random
-import math
+import asyncio
 import json
 import os
+import re
 import sys
 import logging
-import threading
-from typing import Dict, List
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import numpy as np
+import orjson
 import chess
 import chess.engine
-import chess.pgn
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: without it the kernels below run as plain Python
+    def njit(*args, **kwargs):
+        return lambda f: f
 
 # =============================================================================
 # Configuration
@@ -30,12 +37,23 @@ import chess.pgn
 
 ENGINE_PATH = "../build/sleepmind"
 OPENING_BOOK_PATH = "/home/paschty/Downloads/2moves_v2.pgn"
+# Start FENs precomputed from the book (--build-cache); used instead of the
+# PGN when present and not older than the book
+OPENING_CACHE_PATH = "openings.fens.txt"
 
 TIME_PER_MOVE_MS = int(os.environ.get("SPSA_MOVETIME_MS", "1000"))
+# Seed for perturbations and opening choice (unset = fresh entropy every run)
+SEED = int(os.environ["SPSA_SEED"]) if "SPSA_SEED" in os.environ else None
 MAX_ITERATIONS = 36000   # one iteration = one opening pair (2 games), fishtest-style
+# No SPRT early stopping: every update consumes exactly one pair, so there is
+# no multi-game match whose result could be decided early. Noise per update
+# is controlled by the gain schedules (and ANTITHETIC_BLOCK) instead.
 SAVE_INTERVAL = 50       # save state every N completed pairs
 PRINT_INTERVAL = 50      # print full parameter state every N completed pairs
 MAX_PARALLEL_GAMES = 24  # = physical cores on the 14900K
+# Dropped pairs don't count toward MAX_ITERATIONS; stop instead of retrying
+# forever when games fail systematically (bad binary, rejected option value)
+MAX_CONSECUTIVE_DROPS = 2 * MAX_PARALLEL_GAMES
 
 # Spall decay schedules (fishtest-style): the c/r values in PARAMETERS are
 # END values; early iterations use larger perturbations and learning rates.
@@ -44,15 +62,55 @@ MAX_PARALLEL_GAMES = 24  # = physical cores on the 14900K
 SPSA_ALPHA = 0.602
 SPSA_GAMMA = 0.101
 SPSA_A = MAX_ITERATIONS // 10  # stabilization constant
+# Saved with the state: resuming under a different schedule changes c_k/r_k
+SPSA_SCHEDULE = {"alpha": SPSA_ALPHA, "gamma": SPSA_GAMMA, "A": SPSA_A,
+                 "max_iterations": MAX_ITERATIONS}
 
 # Updates happen per pair (2 games), but the r values below follow the c/4
 # heuristic calibrated for ~24-game batches. Scale per-pair updates so the
 # drift and noise per *game* stay the same as with 24-game batches.
 R_PAIR_SCALE = 2.0 / 24.0
 
+# How θ±c_k is turned into engine integers. "stochastic" (fishtest f0):
+# floor(x + U[0,1)), unbiased, so sub-integer drift in θ still reaches the
+# engine on average. "nearest": round θ and c_k separately (old behavior).
+ROUNDING = "stochastic"
+
+# How updates are kept inside [min, max]. "careful" (fishtest f2): a step
+# toward a bound moves at most half the remaining distance, so θ approaches
+# the bound instead of being pinned on it. "hard": plain clip (old behavior).
+CLIPPING = "careful"
+
+# Common random numbers: reuse the same perturbation direction for this many
+# consecutive pairs before drawing a new one. Each pair is already a paired
+# difference (same opening, colors swapped); sharing Δ across a block lowers
+# gradient variance at the cost of some bias. 1 = fresh Δ every pair;
+# ~4 is reasonable early in a run, while c_k is still large.
+ANTITHETIC_BLOCK = max(1, int(os.environ.get("SPSA_ANTITHETIC_BLOCK", "1")))
+
+# Pair outcomes are pentanomial: θ+ half-points over both games (0..4, i.e.
+# LL, LD, DD or WL, WD, WW). Score per outcome is a table lookup, and the
+# outcome counts are one array, so no per-result branching on who was White.
+PAIR_SCORES = np.array([0.0, 0.25, 0.5, 0.75, 1.0])
+
+# Adjudication (cutechess -resign/-draw style) on the engines' own scores,
+# seen from one fixed side, so decided games don't play out to mate or 50 moves.
+# Resign: both engines agree |score| >= RESIGN_SCORE_CP for RESIGN_PLIES plies.
+# Draw: |score| <= DRAW_SCORE_CP for DRAW_PLIES plies after DRAW_MOVE_NUMBER.
+RESIGN_SCORE_CP = 900
+RESIGN_PLIES = 6
+DRAW_SCORE_CP = 8
+DRAW_PLIES = 10
+DRAW_MOVE_NUMBER = 40
+MATE_SCORE_CP = 100000
+
 logging.getLogger("chess.engine").setLevel(logging.ERROR)
 
 
+class TuningAborted(Exception):
+    """Games keep failing; the run stops (state is still saved)"""
+
+
 # =============================================================================
 # Parameter Definitions (Fishtest/OpenBench Style)
 # =============================================================================
@@ -178,44 +236,208 @@ PARAMETERS = {
 }
 
 
+# =============================================================================
+# SPSA Kernels
+# =============================================================================
+# Flat loops over the parameter arrays, JIT-compiled when numba is available.
+# Outputs are written into caller-provided buffers.
+
+@njit(cache=True)
+def perturb_kernel(theta, c_k, pmin, pmax, direction, u_plus, u_minus, stochastic,
+                   theta_plus, theta_minus):
+    """θ± = clip(θ ± c_k * Δ) into integer outputs. stochastic: floor(x + u)
+    with u ~ U[0,1) from u_plus/u_minus; otherwise round(θ) ± round(c_k) * Δ"""
+    for i in range(theta.shape[0]):
+        if stochastic:
+            step = c_k[i] * direction[i]
+            plus = np.floor(theta[i] + step + u_plus[i])
+            minus = np.floor(theta[i] - step + u_minus[i])
+        else:
+            base = np.rint(theta[i])
+            step = np.rint(c_k[i]) * direction[i]
+            plus = base + step
+            minus = base - step
+        theta_plus[i] = min(max(plus, pmin[i]), pmax[i])
+        theta_minus[i] = min(max(minus, pmin[i]), pmax[i])
+
+
+@njit(cache=True)
+def update_kernel(theta, r_k, pmin, pmax, direction, gradient, careful):
+    """θ += r_k * gradient * Δ, in place. careful: each increment is limited
+    to half the distance to the bound it moves toward; otherwise clip"""
+    for i in range(theta.shape[0]):
+        inc = r_k[i] * gradient * direction[i]
+        if careful:
+            if inc > 0:
+                theta[i] += min(inc, (pmax[i] - theta[i]) / 2)
+            else:
+                theta[i] -= min(-inc, (theta[i] - pmin[i]) / 2)
+        else:
+            theta[i] = min(max(theta[i] + inc, pmin[i]), pmax[i])
+
+
 # =============================================================================
 # Opening Book
 # =============================================================================
 
 class OpeningBook:
-    def __init__(self, pgn_path: str):
+    # Games start at their [Event] tag (first tag of the Seven Tag Roster)
+    GAME_SPLIT_RE = re.compile(rb"\r?\n(?=\[Event )")
+    # Everything the scanner cares about in one pass; unmatched bytes (move
+    # numbers, NAGs, whitespace) fall between tokens and are skipped
+    TOKEN_RE = re.compile(rb"""
+          \[[^\]]*\]                                       # tag pair
+        | \{[^}]*\}                                         # brace comment
+        | ;[^\n]*                                           # rest-of-line comment
+        | [()]                                              # variation start / end
+        | 1-0 | 0-1 | 1/2-1/2 | \*                           # game termination
+        | O-O(?:-O)?[+\#]? | 0-0(?:-0)?[+\#]?                # castling
+        | [NBRQK]?[a-h]?[1-8]?x?[a-h][1-8](?:=?[NBRQ])?[+\#]?  # SAN move
+    """, re.VERBOSE)
+    RESULTS = (b"1-0", b"0-1", b"1/2-1/2", b"*")
+    # Books at least this big are scanned in chunks by a process pool; below
+    # it, worker startup costs more than the whole scan
+    PARALLEL_SCAN_BYTES = 1 << 20
+
+    def __init__(self, pgn_path: str, rng: np.random.Generator = None,
+                 cache_path: Optional[str] = None):
         self.openings = []
+        # Precomputed start FENs, one per book line; replaces openings if loaded
+        self.fens: List[str] = []
+        self.rng = rng if rng is not None else np.random.default_rng()
+        # Start FEN per (opening index, plies): each book line is replayed once
+        self.fen_cache: Dict[tuple, str] = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            if os.path.exists(pgn_path) and os.path.getmtime(cache_path) < os.path.getmtime(pgn_path):
+                print(f"Warning: {cache_path} is older than {pgn_path}, ignoring it "
+                      f"(rebuild with --build-cache)")
+            else:
+                self.load_cache(cache_path)
+                if self.fens:
+                    return
+                print(f"Warning: {cache_path} is empty, ignoring it")
         self.load_openings(pgn_path)
 
+    @classmethod
+    def _scan(cls, buf: bytes, max_plies: int = 8) -> List[List[str]]:
+        """First max_plies mainline SAN tokens of every game in buf.
+        Tags, comments and parenthesized variations (at any depth) are
+        skipped; SAN is only validated later, when an opening is replayed."""
+        openings = []
+        for game in cls.GAME_SPLIT_RE.split(buf):
+            sans = []
+            variation_depth = 0
+            for match in cls.TOKEN_RE.finditer(game):
+                token = match.group()
+                first = token[:1]
+                if first in b"[{;":
+                    continue
+                if first == b"(":
+                    variation_depth += 1
+                elif first == b")":
+                    variation_depth -= 1
+                elif variation_depth == 0:
+                    if token in cls.RESULTS:
+                        break
+                    sans.append(token.decode("ascii"))
+                    if len(sans) >= max_plies:
+                        break
+            if len(sans) >= 4:
+                openings.append(sans)
+        return openings
+
+    @classmethod
+    def _scan_range(cls, pgn_path: str, start: int, end: int) -> List[List[str]]:
+        """_scan of bytes [start, end) of the book (process pool worker)"""
+        with open(pgn_path, 'rb') as pgn_file:
+            with mmap.mmap(pgn_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return cls._scan(mm[start:end])
+
+    @classmethod
+    def _chunk_bounds(cls, mm: mmap.mmap, n_chunks: int) -> List[int]:
+        """Offsets splitting mm into about n_chunks ranges, each starting
+        at an [Event] tag so no game straddles two chunks"""
+        size = len(mm)
+        bounds = [0]
+        for k in range(1, n_chunks):
+            pos = mm.find(b"\n[Event ", max(bounds[-1], size * k // n_chunks))
+            if pos < 0:
+                break
+            if pos + 1 > bounds[-1]:
+                bounds.append(pos + 1)
+        bounds.append(size)
+        return bounds
+
     def load_openings(self, pgn_path: str):
         if not os.path.exists(pgn_path):
             print(f"Warning: Opening book not found at {pgn_path}")
             return
 
         print(f"Loading opening book from {pgn_path}...")
-        with open(pgn_path, 'r', encoding='utf-8', errors='ignore') as pgn_file:
-            while True:
-                game = chess.pgn.read_game(pgn_file)
-                if game is None:
-                    break
-
-                moves = list(game.mainline_moves())
-                if len(moves) >= 4:
-                    self.openings.append(moves)
+        n_workers = os.cpu_count() or 1
+        with open(pgn_path, 'rb') as pgn_file:
+            if n_workers == 1 or os.fstat(pgn_file.fileno()).st_size < self.PARALLEL_SCAN_BYTES:
+                self.openings = self._scan(pgn_file.read())
+            else:
+                with mmap.mmap(pgn_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    bounds = self._chunk_bounds(mm, n_workers)
+                # Workers map the file themselves: only offsets are pickled.
+                # map() keeps chunk order, so indices match a serial scan.
+                with ProcessPoolExecutor(n_workers) as pool:
+                    chunks = pool.map(self._scan_range, [pgn_path] * (len(bounds) - 1),
+                                      bounds[:-1], bounds[1:])
+                    self.openings = [sans for chunk in chunks for sans in chunk]
 
         print(f"Loaded {len(self.openings)} openings")
 
-    def get_opening(self, max_moves: int = 8) -> List[chess.Move]:
+    def load_cache(self, cache_path: str):
+        with open(cache_path) as cache_file:
+            self.fens = cache_file.read().splitlines()
+        print(f"Loaded {len(self.fens)} opening FENs from {cache_path}")
+
+    def build_cache(self, cache_path: str, max_moves: int = 8):
+        """Write the start FEN of every book line, in book order, so a seeded
+        run picks the same openings from the cache as from the PGN"""
+        if not self.openings:
+            print("Error: no openings to cache")
+            sys.exit(1)
+        fens = [self.opening_fen(index, max_moves) for index in range(len(self.openings))]
+        with open(cache_path, "w") as cache_file:
+            cache_file.writelines(fen + "\n" for fen in fens)
+        print(f"Wrote {len(fens)} opening FENs to {cache_path}")
+
+    def get_opening(self, max_moves: int = 8) -> str:
+        """Random opening FEN. From a cache the FEN is used as built;
+        otherwise max_moves (even) plies of a random book line are replayed."""
+        if self.fens:
+            return self.fens[int(self.rng.integers(len(self.fens)))]
         if not self.openings:
-            return []
+            return chess.STARTING_FEN
+        return self.opening_fen(int(self.rng.integers(len(self.openings))), max_moves)
 
-        opening = random.choice(self.openings)
+    def opening_fen(self, index: int, max_moves: int = 8) -> str:
+        """FEN after the first (even) plies of book line index"""
+        opening = self.openings[index]
         n = min(len(opening), max_moves)
         if n % 2 == 1:
             n -= 1
-        return opening[:n]
 
-    def get_openings(self, count: int) -> List[List[chess.Move]]:
+        fen = self.fen_cache.get((index, n))
+        if fen is None:
+            board = chess.Board()
+            for san in opening[:n]:
+                try:
+                    board.push_san(san)
+                except ValueError:
+                    # Keep the legal prefix, like chess.pgn does for bad SAN
+                    if len(board.move_stack) % 2 == 1:
+                        board.pop()
+                    break
+            fen = board.fen()
+            self.fen_cache[(index, n)] = fen
+        return fen
+
+    def get_openings(self, count: int) -> List[str]:
         return [self.get_opening() for _ in range(count)]
 
 
@@ -225,216 +447,393 @@ class OpeningBook:
 
 class SPSATuner:
     def __init__(self, tune_only=None):
+        # Which parameters to actually tune (None = all)
+        self.tune_only = tune_only
+
+        # PARAMETERS as parallel arrays (one slot per name) so perturbation and
+        # update are a few vectorized ops; dicts only exist at the engine boundary
+        self.names = list(PARAMETERS)
+        self.name_to_idx: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        self.default = np.array([PARAMETERS[n]["default"] for n in self.names], dtype=np.int64)
+        self.c = np.array([PARAMETERS[n]["c"] for n in self.names], dtype=np.float64)
+        self.r = np.array([PARAMETERS[n]["r"] for n in self.names], dtype=np.float64)
+        self.pmin = np.array([PARAMETERS[n]["min"] for n in self.names], dtype=np.float64)
+        self.pmax = np.array([PARAMETERS[n]["max"] for n in self.names], dtype=np.float64)
+        self.tunable_mask = np.array([tune_only is None or n in tune_only for n in self.names])
+        self.rng = np.random.default_rng(SEED)
+        self.block_direction = None
+        self.block_left = 0
+
         # Store params as floats internally for smooth updates
-        self.params = {name: float(info["default"]) for name, info in PARAMETERS.items()}
+        self.theta = self.default.astype(np.float64)
         self.best_params = self.get_int_params()
         self.iteration = 0
-        self.history = []
-        self.opening_book = OpeningBook(OPENING_BOOK_PATH)
-        # Which parameters to actually tune (None = all)
-        self.tune_only = tune_only
+        self.pentanomial = np.zeros(5, dtype=np.int64)
+        self.games_played = 0
+        self.games_failed = 0
+        self.consecutive_drops = 0
+        self.opening_book = OpeningBook(OPENING_BOOK_PATH, self.rng, OPENING_CACHE_PATH)
+
+        # Engines and pair tasks live in the event loop (see run_pairs)
+        self.last_options: Dict[int, np.ndarray] = {}
+        # Every running engine, pooled or not, so shutdown can quit them all
+        self.live_engines: set = set()
+        self.option_mask: Optional[np.ndarray] = None  # options the engine has
 
         self.load_state()
+        if SEED is not None and self.iteration:
+            # Seeded resume: a stream of its own per resume point, instead of
+            # replaying the Δs, openings and rounding draws of iteration 0
+            self.rng = np.random.default_rng([SEED, self.iteration])
+            self.opening_book.rng = self.rng
 
-    def get_int_params(self) -> Dict[str, int]:
-        """Convert float params to integers for engine"""
-        return {name: self.clamp_param(name, round(self.params[name])) for name in self.params}
+    def get_int_theta(self) -> np.ndarray:
+        """Current θ rounded and clamped to engine integers"""
+        return np.clip(np.round(self.theta), self.pmin, self.pmax).astype(np.int64)
 
-    def clamp_param(self, name: str, value: int) -> int:
-        info = PARAMETERS[name]
-        return max(info["min"], min(info["max"], value))
+    def get_int_params(self) -> Dict[str, int]:
+        """Current θ as a name -> int dict (history and output files)"""
+        return dict(zip(self.names, self.get_int_theta().tolist()))
 
     def load_state(self):
         if os.path.exists("spsa_state.json"):
-            with open("spsa_state.json", "r") as f:
-                state = json.load(f)
+            with open("spsa_state.json", "rb") as f:
+                state = orjson.loads(f.read())
                 # Merge: keep defaults for params added after the state was saved
                 for k, v in state.get("params", {}).items():
-                    if k in self.params:
-                        self.params[k] = float(v)
+                    i = self.name_to_idx.get(k)
+                    if i is not None:
+                        self.theta[i] = float(v)
                 self.best_params = state.get("best_params", self.best_params)
                 self.iteration = state.get("iteration", 0)
+                self.pentanomial[:] = state.get("pentanomial", [0] * 5)
+                self.games_played = state.get("games_played", 0)
+                self.games_failed = state.get("games_failed", 0)
+                schedule = state.get("schedule", SPSA_SCHEDULE)
             print(f"Resumed from iteration {self.iteration}")
-
-        if os.path.exists("spsa_history.json"):
-            with open("spsa_history.json", "r") as f:
-                self.history = json.load(f)
+            if schedule != SPSA_SCHEDULE:
+                print(f"Warning: gain schedule changed since last save ({schedule} -> {SPSA_SCHEDULE}), "
+                      f"c_k/r_k continue from iteration {self.iteration} on the new one")
+
+        # History is append-only JSONL, written once per pair. On resume drop
+        # pairs logged after the last state save (they will be replayed) and
+        # a torn last line from an interrupted write; migrate old .json files.
+        history = []
+        if os.path.exists("spsa_history.jsonl"):
+            with open("spsa_history.jsonl", "rb") as f:
+                for line in f:
+                    try:
+                        history.append(orjson.loads(line))
+                    except orjson.JSONDecodeError:
+                        break
+        elif os.path.exists("spsa_history.json"):
+            with open("spsa_history.json", "rb") as f:
+                history = orjson.loads(f.read())
+        else:
+            return
+        with open("spsa_history.jsonl", "wb") as f:
+            f.writelines(orjson.dumps(entry) + b"\n" for entry in history
+                         if entry["iteration"] <= self.iteration)
 
     def save_state(self):
         state = {
-            "params": self.params,
+            "params": dict(zip(self.names, self.theta.tolist())),
             "best_params": self.best_params,
-            "iteration": self.iteration
+            "iteration": self.iteration,
+            "pentanomial": self.pentanomial,
+            "games_played": self.games_played,
+            "games_failed": self.games_failed,
+            "schedule": SPSA_SCHEDULE
         }
-        with open("spsa_state.json", "w") as f:
-            json.dump(state, f, indent=2)
-
-        with open("spsa_history.json", "w") as f:
-            json.dump(self.history, f, indent=2)
-
-    def get_perturbation(self) -> Dict[str, int]:
-        """Generate ±1 direction for each tuned parameter, 0 for fixed ones"""
-        return {
-            name: random.choice([-1, 1]) if self.tune_only is None or name in self.tune_only else 0
-            for name in PARAMETERS
-        }
-
-    def current_c(self, name: str) -> float:
-        """Perturbation size at this iteration (decays toward PARAMETERS c)"""
-        k = max(1, self.iteration + 1)
-        return PARAMETERS[name]["c"] * (MAX_ITERATIONS / k) ** SPSA_GAMMA
-
-    def current_r(self, name: str) -> float:
-        """Learning rate at this iteration (decays toward PARAMETERS r)"""
+        with open("spsa_state.json", "wb") as f:
+            f.write(orjson.dumps(state, option=orjson.OPT_SERIALIZE_NUMPY))
+
+    def append_history(self, entry: dict):
+        with open("spsa_history.jsonl", "ab") as f:
+            f.write(orjson.dumps(entry) + b"\n")
+
+    def get_perturbation(self) -> np.ndarray:
+        """Generate ±1 direction for each tuned parameter, 0 for fixed ones.
+        The whole Rademacher vector is drawn in a single generator call and
+        reused for ANTITHETIC_BLOCK consecutive pairs."""
+        if self.block_left == 0:
+            delta = self.rng.integers(0, 2, size=len(self.names), dtype=np.int8) * 2 - 1
+            self.block_direction = delta * self.tunable_mask
+            self.block_left = ANTITHETIC_BLOCK
+        self.block_left -= 1
+        return self.block_direction
+
+    def gain_scales(self) -> tuple:
+        """Decay factors (c_k / c_end, r_k / r_end) at this iteration; one
+        pair of scalar powers shared by every parameter"""
         k = max(1, self.iteration + 1)
-        return PARAMETERS[name]["r"] * ((SPSA_A + MAX_ITERATIONS) / (SPSA_A + k)) ** SPSA_ALPHA
-
-    def create_theta_plus_minus(self, direction: Dict[str, int]) -> tuple:
-        """Create θ+ and θ- parameter sets"""
-        theta_plus = {}
-        theta_minus = {}
-
-        for name, d in direction.items():
-            c = round(self.current_c(name))
-            base = round(self.params[name])
-
-            plus_val = self.clamp_param(name, base + c * d)
-            minus_val = self.clamp_param(name, base - c * d)
-
-            theta_plus[name] = plus_val
-            theta_minus[name] = minus_val
-
+        return ((MAX_ITERATIONS / k) ** SPSA_GAMMA,
+                ((SPSA_A + MAX_ITERATIONS) / (SPSA_A + k)) ** SPSA_ALPHA)
+
+    def current_c(self) -> np.ndarray:
+        """Perturbation sizes at this iteration (decay toward PARAMETERS c)"""
+        return self.c * self.gain_scales()[0]
+
+    def current_r(self) -> np.ndarray:
+        """Learning rates at this iteration (decay toward PARAMETERS r)"""
+        return self.r * self.gain_scales()[1]
+
+    def create_theta_plus_minus(self, direction: np.ndarray) -> tuple:
+        """Create θ+ and θ- parameter sets (int arrays, one slot per name)"""
+        # Fresh buffers per pair: they travel with the job to its pair task
+        n = len(self.names)
+        theta_plus = np.empty(n, dtype=np.int64)
+        theta_minus = np.empty(n, dtype=np.int64)
+        u = self.rng.random(2 * n)
+        perturb_kernel(self.theta, self.current_c(), self.pmin, self.pmax, direction,
+                       u[:n], u[n:], ROUNDING == "stochastic", theta_plus, theta_minus)
         return theta_plus, theta_minus
 
-    def play_pair(self, theta_plus: Dict[str, int], theta_minus: Dict[str, int],
-                  opening: List[chess.Move]) -> float:
-        """Play one opening pair (color swap), sequentially on this worker slot.
-        Returns score for θ+ in [0, 1]."""
-        r1 = self.play_game(theta_plus, theta_minus, opening)   # θ+ is White
-        r2 = self.play_game(theta_minus, theta_plus, opening)   # θ+ is Black
-        return ((r1 + 1) / 2 + (1 - r2) / 2) / 2
-
-    def play_game(self, white_params: Dict[str, int], black_params: Dict[str, int],
-                  opening: List[chess.Move]) -> int:
-        """Play single game. Returns 1=white wins, -1=black wins, 0=draw"""
-        engine_w = None
-        engine_b = None
-
+    async def start_engine(self) -> chess.engine.UciProtocol:
+        # Own process group: a terminal Ctrl-C must not kill games in flight
+        _, engine = await chess.engine.popen_uci(ENGINE_PATH, setpgrp=True)
+        if self.option_mask is None:
+            self.option_mask = np.array([name in engine.options for name in self.names])
+            # Engines start before the first Δ is drawn, so θ never moves for these
+            self.tunable_mask &= self.option_mask
+            for name in (n for n, ok in zip(self.names, self.option_mask.tolist()) if not ok):
+                print(f"Warning: engine does not support option {name}, not tuning it")
+        # Shadow starts at the values the engine reports it is running with,
+        # so parameters still at their default are never sent at all
+        self.live_engines.add(engine)
+        self.last_options[id(engine)] = np.array(
+            [engine.options[name].default if ok else 0
+             for name, ok in zip(self.names, self.option_mask.tolist())], dtype=np.int64)
+        return engine
+
+    async def stop_engine(self, engine: chess.engine.UciProtocol):
+        self.last_options.pop(id(engine), None)
         try:
-            engine_w = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
-            engine_b = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
+            await engine.quit()
+        except chess.engine.EngineError:
+            pass  # already dead
+        self.live_engines.discard(engine)
+
+    async def release_engine(self, engine: chess.engine.UciProtocol, broken: bool = False):
+        """Return engine to the pool; a broken one is replaced by a fresh process"""
+        if broken:
+            await self.stop_engine(engine)
+            engine = await self.start_engine()
+        self.engine_pool.put_nowait(engine)
+
+    async def configure_engine(self, engine: chess.engine.UciProtocol, params: np.ndarray):
+        """Send setoption only for values that differ from the engine's shadow,
+        batched into a single configure command"""
+        last = self.last_options[id(engine)]
+        changed = np.flatnonzero((params != last) & self.option_mask)
+        if changed.size:
+            await engine.configure({self.names[i]: int(params[i]) for i in changed.tolist()})
+            last[changed] = params[changed]
+
+    async def play_pair(self, theta_plus: np.ndarray, theta_minus: np.ndarray,
+                        start_fen: str) -> tuple:
+        """Play one opening pair (color swap), sequentially in this pair task.
+        Returns (pentanomial outcome for θ+, i.e. index into PAIR_SCORES, or
+        None if a game failed twice; game attempts; failed game attempts)."""
+        outcome = 2
+        played = failed = 0
+        for plus_white in (True, False):
+            result = await self.play_game(theta_plus, theta_minus, plus_white, start_fen)
+            played += 1
+            if result is None:
+                # Failed engines were replaced; retry once on fresh ones
+                failed += 1
+                result = await self.play_game(theta_plus, theta_minus, plus_white, start_fen)
+                played += 1
+            if result is None:
+                return None, played, failed + 1
+            outcome += result
+        return outcome, played, failed
+
+    async def play_game(self, params_a: np.ndarray, params_b: np.ndarray,
+                        a_white: bool, start_fen: str) -> Optional[int]:
+        """Play single game of A vs B. Returns the result from A's side:
+        1=A wins, -1=B wins, 0=draw, None if an engine failed (it is
+        replaced by a fresh process)"""
+        engine_a = await self.engine_pool.get()
+        engine_b = await self.engine_pool.get()
+        a_color = chess.WHITE if a_white else chess.BLACK
+        broken = False
 
-            for name, val in white_params.items():
-                try:
-                    engine_w.configure({name: val})
-                except:
-                    pass
-            for name, val in black_params.items():
-                try:
-                    engine_b.configure({name: val})
-                except:
-                    pass
+        try:
+            await self.configure_engine(engine_a, params_a)
+            await self.configure_engine(engine_b, params_b)
 
-            board = chess.Board()
-            for move in opening:
-                if move in board.legal_moves:
-                    board.push(move)
+            board = chess.Board(start_fen)
 
+            # A new game token makes python-chess send ucinewgame before the first move
+            game = object()
+            a_streak = b_streak = draw_streak = 0
             while not board.is_game_over():
-                engine = engine_w if board.turn == chess.WHITE else engine_b
-                result = engine.play(board, chess.engine.Limit(time=TIME_PER_MOVE_MS / 1000))
+                engine = engine_a if board.turn == a_color else engine_b
+                result = await engine.play(board, chess.engine.Limit(time=TIME_PER_MOVE_MS / 1000),
+                                           game=game, info=chess.engine.INFO_SCORE)
                 board.push(result.move)
+                if board.is_game_over():
+                    break  # a real result always beats adjudication
+
+                score = result.info.get("score")
+                if score is None:
+                    a_streak = b_streak = draw_streak = 0
+                    continue
+                cp = score.pov(a_color).score(mate_score=MATE_SCORE_CP)
+                a_streak = a_streak + 1 if cp >= RESIGN_SCORE_CP else 0
+                b_streak = b_streak + 1 if cp <= -RESIGN_SCORE_CP else 0
+                if a_streak >= RESIGN_PLIES:
+                    return 1
+                if b_streak >= RESIGN_PLIES:
+                    return -1
+                if board.fullmove_number > DRAW_MOVE_NUMBER:
+                    draw_streak = draw_streak + 1 if abs(cp) <= DRAW_SCORE_CP else 0
+                    if draw_streak >= DRAW_PLIES:
+                        return 0
 
             if board.is_checkmate():
-                return -1 if board.turn == chess.WHITE else 1
+                # The side to move is mated
+                return -1 if board.turn == a_color else 1
             return 0
 
-        except:
-            return 0
+        except (chess.engine.EngineError, BrokenPipeError) as exc:
+            print(f"Warning: game failed ({type(exc).__name__}: {exc})")
+            broken = True
+            return None
 
         finally:
-            for eng in [engine_w, engine_b]:
-                if eng:
-                    try:
-                        eng.quit()
-                    except:
-                        pass
+            await self.release_engine(engine_a, broken)
+            await self.release_engine(engine_b, broken)
 
-    def apply_update(self, direction: Dict[str, int], score: float):
-        """Fishtest-style update from one pair result. Caller holds the lock.
+    def apply_update(self, direction: np.ndarray, score: float):
+        """Fishtest-style update from one pair result.
         θ += r * (score - 0.5) * 2 * direction, r scaled to pair size."""
         gradient = (score - 0.5) * 2  # Range: -1 to +1
 
-        for name in PARAMETERS:
-            d = direction[name]
-            if d == 0:
-                continue
-            r = self.current_r(name) * R_PAIR_SCALE
-            info = PARAMETERS[name]
-            new_val = self.params[name] + r * gradient * d
-            self.params[name] = max(float(info["min"]), min(float(info["max"]), new_val))
-
-    def worker(self):
-        """One asynchronous SPSA step: snapshot θ±c, play a pair, update θ."""
-        with self.lock:
-            if self.iteration >= MAX_ITERATIONS:
-                return
+        r = self.current_r() * R_PAIR_SCALE
+        update_kernel(self.theta, r, self.pmin, self.pmax, direction, gradient,
+                      CLIPPING == "careful")
+
+    def iter_jobs(self):
+        """Endless stream of pairs to play. Lazy on purpose: θ±c is only
+        snapshotted when a slot frees up, so it includes every update so far."""
+        while True:
             direction = self.get_perturbation()
             theta_plus, theta_minus = self.create_theta_plus_minus(direction)
-        opening = self.opening_book.get_opening()
-
-        score = self.play_pair(theta_plus, theta_minus, opening)
-
-        with self.lock:
-            self.apply_update(direction, score)
-            self.iteration += 1
-            it = self.iteration
-
-            self.history.append({
-                "iteration": it,
-                "score": score,
-                "params": self.get_int_params()
-            })
-
-            print(f"[{it}/{MAX_ITERATIONS}] pair score θ+: {score:.2f}")
-
-            if it % PRINT_INTERVAL == 0:
-                print(f"\n--- Parameters after {it} pairs ({it * 2} games) ---")
-                int_params = self.get_int_params()
-                for name in PARAMETERS:
-                    diff = int_params[name] - PARAMETERS[name]["default"]
-                    sign = "+" if diff > 0 else ""
-                    print(f"  {name}: {int_params[name]} ({sign}{diff} from default)")
-                print()
-
-            if it % SAVE_INTERVAL == 0:
-                self.save_state()
+            yield direction, theta_plus, theta_minus, self.opening_book.get_opening()
+
+    async def collect_results(self, in_flight: Dict[asyncio.Task, np.ndarray]):
+        """Wait until at least one in-flight pair finishes and record each
+        finished one. An unexpected error in a pair task is re-raised here."""
+        done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            self.record_result(in_flight.pop(task), *task.result())
+
+    def record_result(self, direction: np.ndarray, outcome: Optional[int],
+                      played: int, failed: int):
+        """Apply one finished pair: update θ, log, print and save. A pair with
+        a game that failed twice is dropped rather than scored as a draw."""
+        self.games_played += played
+        self.games_failed += failed
+        if outcome is None:
+            print("Warning: pair dropped after repeated engine failures")
+            self.consecutive_drops += 1
+            if self.consecutive_drops >= MAX_CONSECUTIVE_DROPS:
+                raise TuningAborted(f"{self.consecutive_drops} pairs in a row dropped "
+                                   f"after engine failures, giving up")
+            return
+        self.consecutive_drops = 0
+
+        score = float(PAIR_SCORES[outcome])
+        self.pentanomial[outcome] += 1
+        self.apply_update(direction, score)
+        self.iteration += 1
+        it = self.iteration
+
+        self.append_history({
+            "iteration": it,
+            "score": score,
+            "failed": failed,
+            "params": self.get_int_params()
+        })
+
+        print(f"[{it}/{MAX_ITERATIONS}] pair score θ+: {score:.2f}")
+
+        if it % PRINT_INTERVAL == 0:
+            print(f"\n--- Parameters after {it} pairs ({it * 2} games) ---")
+            values = self.get_int_theta()
+            for name, val, diff in zip(self.names, values.tolist(), (values - self.default).tolist()):
+                sign = "+" if diff > 0 else ""
+                print(f"  {name}: {val} ({sign}{diff} from default)")
+            print(f"  Pentanomial θ+ [LL, LD, DD/WL, WD, WW]: {self.pentanomial.tolist()}")
+            print(f"  Failed games: {self.games_failed}/{self.games_played}")
+            print()
+
+        if it % SAVE_INTERVAL == 0:
+            self.save_state()
 
     def run_async(self):
-        """Continuous fishtest-style loop: MAX_PARALLEL_GAMES worker slots,
-        each plays one opening pair and applies its update immediately —
+        """Continuous fishtest-style loop: MAX_PARALLEL_GAMES pair slots,
+        each plays one opening pair and its update is applied immediately —
         no iteration barrier, no idle cores waiting for stragglers."""
-        self.lock = threading.Lock()
-        remaining = MAX_ITERATIONS - self.iteration
-        if remaining <= 0:
+        if self.iteration >= MAX_ITERATIONS:
             print("MAX_ITERATIONS already reached.")
             return
-
-        executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_GAMES)
-        futures = [executor.submit(self.worker) for _ in range(remaining)]
+        asyncio.run(self.run_pairs())
+
+    async def run_pairs(self):
+        """All games run as tasks on one event loop; engine I/O is plain
+        non-blocking pipes instead of one blocked OS thread per engine."""
+        # Long-lived engines shared by all pair slots: no popen/UCI handshake
+        # per game, only the options that changed since the engine's last game
+        self.engine_pool: "asyncio.Queue[chess.engine.UciProtocol]" = asyncio.Queue()
+        for engine in await asyncio.gather(*(self.start_engine() for _ in range(2 * MAX_PARALLEL_GAMES))):
+            self.engine_pool.put_nowait(engine)
+
+        # Window of pair tasks (task -> its Δ), refilled as pairs finish; all
+        # SPSA bookkeeping happens here, between awaits, so nothing else
+        # touches θ concurrently. One pair per slot: each game already holds
+        # two engines, so a wider window would only queue on the pool.
+        jobs = self.iter_jobs()
+        in_flight: Dict[asyncio.Task, np.ndarray] = {}
         try:
-            for future in as_completed(futures):
-                exc = future.exception()
-                if exc is not None:
-                    print(f"Worker error: {exc}")
-        except KeyboardInterrupt:
-            print("\nInterrupted - cancelling pending pairs, waiting for running games...")
-            executor.shutdown(wait=True, cancel_futures=True)
+            while True:
+                # Keep every slot busy until finished + in-flight pairs reach
+                # MAX_ITERATIONS; a dropped pair frees a slot without advancing
+                while (len(in_flight) < MAX_PARALLEL_GAMES
+                       and self.iteration + len(in_flight) < MAX_ITERATIONS):
+                    direction, theta_plus, theta_minus, start_fen = next(jobs)
+                    task = asyncio.create_task(self.play_pair(theta_plus, theta_minus, start_fen))
+                    in_flight[task] = direction
+                if not in_flight:
+                    break
+                await self.collect_results(in_flight)
+        except asyncio.CancelledError:
+            # First Ctrl-C cancels this task; re-raising after the drain lets
+            # asyncio.run turn it into KeyboardInterrupt for main()
+            print("\nInterrupted - waiting for running games...")
+            while in_flight:
+                await self.collect_results(in_flight)
             raise
-        executor.shutdown()
+        finally:
+            # Empty after a normal finish or drain; mid-game only on an error
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+            # A pair cancelled while replacing failed engines holds engines
+            # that never made it back to the pool
+            for engine in list(self.live_engines):
+                await self.stop_engine(engine)
 
 
 def main():
+    # One-off preprocessing: replay the book once, write start FENs, exit
+    if sys.argv[1:] == ["--build-cache"]:
+        OpeningBook(OPENING_BOOK_PATH).build_cache(OPENING_CACHE_PATH)
+        return
+
     # Parse optional parameter names from command line
     tune_only = None
     if len(sys.argv) > 1:
@@ -457,6 +856,8 @@ def main():
     else:
         print("Tuning all parameters.")
     print(f"Update granularity: 1 opening pair (2 games), asynchronous")
+    if ANTITHETIC_BLOCK > 1:
+        print(f"Perturbation reused for {ANTITHETIC_BLOCK} consecutive pairs")
     print(f"Max pairs: {MAX_ITERATIONS} ({MAX_ITERATIONS * 2} games)")
     print(f"Time per move: {TIME_PER_MOVE_MS}ms")
     print(f"Parallel pair slots: {MAX_PARALLEL_GAMES}")
@@ -472,6 +873,10 @@ def main():
         tuner.run_async()
     except KeyboardInterrupt:
         print("\n\nInterrupted.")
+    except TuningAborted as exc:
+        print(f"\n\nError: {exc}")
+        tuner.save_state()
+        sys.exit(1)
 
     tuner.save_state()
 